@@ -1,26 +1,51 @@
 import os
 import glob
+import gzip
 import hashlib
 import json
+import queue
 import re
+import stat
+import struct
+import tempfile
+import threading
 import time
 import zipfile
-from datetime import datetime, timezone
+from collections import OrderedDict
+from concurrent.futures import Future
+from io import BytesIO
 from urllib.parse import quote
+from xml.parsers import expat
 from xml.sax.saxutils import escape
 
 from flask import Flask, Response, send_file, abort, request
+from PIL import Image
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
 
 app = Flask(__name__)
 
 BOOKS_DIR = os.environ.get("BOOKS_DIR", "/books")
+BOOKS_REAL = os.path.realpath(BOOKS_DIR)  # resolved once for download containment checks
 SERVER_TITLE = os.environ.get("SERVER_TITLE", "OPDS Library")
-SCAN_TTL = int(os.environ.get("SCAN_TTL", 60))  # seconds before rescanning
+SCAN_TTL = int(os.environ.get("SCAN_TTL", 60))  # seconds before rescanning when not watching
+# Rescan only when BOOKS_DIR changes; turn off for mounts without inotify (NFS, SMB)
+WATCH_BOOKS = os.environ.get("WATCH_BOOKS", "true").lower() in ("1", "true", "yes")
 CACHE_DIR = os.environ.get("CACHE_DIR", "/cache")
+COVER_CACHE_DIR = os.environ.get("COVER_CACHE_DIR", CACHE_DIR)
+COVER_CACHE_MAX = int(os.environ.get("COVER_CACHE_MAX", 256))  # covers kept in memory
+COVER_CACHE_TTL = int(os.environ.get("COVER_CACHE_TTL", 3600))  # seconds a cover stays in memory
+COVER_NEGATIVE_TTL = int(os.environ.get("COVER_NEGATIVE_TTL", 300))  # seconds to remember a missing cover
+# Threads extracting covers in the background after a scan; 0 disables warming
+COVER_WARM_WORKERS = int(os.environ.get("COVER_WARM_WORKERS", (os.cpu_count() or 1) * 2))
+COVER_WAIT_TIMEOUT = 10  # seconds a request waits on an in-flight background extraction
+THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", 256))  # bounding box in pixels
 
 os.makedirs(CACHE_DIR, exist_ok=True)
+os.makedirs(COVER_CACHE_DIR, exist_ok=True)
 
 SCAN_CACHE_FILE = os.path.join(CACHE_DIR, "scan.json")
+SCAN_CACHE_VERSION = 3  # bump when scan.json or its book dicts change shape or ids
 
 MIME_TYPES = {
     ".epub": "application/epub+zip",
@@ -33,122 +58,347 @@ MIME_TYPES = {
     ".cbr": "application/vnd.comicbook-rar",
 }
 
-# Book scan cache (in-process, populated from filesystem cache or full scan)
+# Matched against the raw container.xml bytes
+_RE_OPF_PATH = re.compile(rb'full-path="([^"]+\.opf)"')
+# Fallback for OPF files expat rejects (e.g. a bare "&" in the metadata)
+_RE_META_COVER_A = re.compile(rb'<meta\s+name=["\']cover["\']\s+content=["\']([^"\']+)["\']')
+_RE_META_COVER_B = re.compile(rb'<meta\s+content=["\']([^"\']+)["\']\s+name=["\']cover["\']')
+_RE_COVER_IMAGE_PROP_A = re.compile(rb'<item[^>]+properties=["\']cover-image["\'][^>]+href=["\']([^"\']+)["\']')
+_RE_COVER_IMAGE_PROP_B = re.compile(rb'<item[^>]+href=["\']([^"\']+)["\'][^>]+properties=["\']cover-image["\']')
+# Filled in with the escaped cover item id
+_ITEM_HREF_BY_ID_A = rb'<item[^>]+id=["\'](?:%s)["\'][^>]+href=["\']([^"\']+)["\']'
+_ITEM_HREF_BY_ID_B = rb'<item[^>]+href=["\']([^"\']+)["\'][^>]+id=["\'](?:%s)["\']'
+
+# Book scan cache (in-process, populated from filesystem cache or full scan).
+# Each entry is a dict built by make_book() so catalog requests never re-stat
+# or re-hash a path.
 _scan_cache: list = []
 _scan_time: float = 0.0
-# book_id -> path for fast cover lookups
-_book_paths: dict = {}
-
-
-def base_url():
-    return request.url_root.rstrip("/")
-
+# book_id -> book for fast cover lookups
+_books_by_id: dict = {}
+# dirpath -> (st_mtime_ns, [(path, mtime)], [subdir paths]) from the last walk
+_dir_cache: dict = {}
+# Directories the watcher saw change; walk_books re-reads them instead of
+# trusting _dir_cache, even when the event arrives while a walk is running
+_stale_dirs: set = set()
+# Feed <entry> elements for _scan_cache, rendered once per scan with
+# BASE_PLACEHOLDER standing in for the request's base URL (url_root without
+# the trailing slash)
+_scan_entries_xml: str = ""
+# Feed <updated>: the newest mtime among the books and the directories
+# holding them, so the feed bytes (and ETag) only change with the library, not
+# with when or by which worker it was rendered. Directory mtimes cover
+# deletions and renames, which leave no newer book behind; the value can
+# still step back if the newest directory itself is removed.
+_scan_updated: str = ""
+# base URL -> (xml_bytes, gzip_bytes, etag) for the current scan, rendered on first request
+_feed_cache: dict = {}
+FEED_CACHE_MAX = 8  # distinct base URLs (hosts) kept per scan
+
+# Set by the filesystem watcher when BOOKS_DIR changes
+_scan_dirty: bool = True
+# Running watchdog Observer, or None while falling back to SCAN_TTL polling
+_watcher = None
+_watcher_started: bool = False
+_watcher_lock = threading.Lock()
+
+# Stands in for the escaped base URL; NUL cannot occur in a file path or title
+BASE_PLACEHOLDER = "\0BASE\0"
+
+# In-memory LRU of (book_id, mtime) -> (expires, result), least recently used first.
+# result is a Future while a background extraction is still pending.
+_cover_cache: OrderedDict = OrderedDict()
+_cover_lock = threading.Lock()
+_MISSING = object()
+# Keys already handed to the warm-up pool, so each cover is extracted once per process
+_cover_warmed: set = set()
+# (book, Future) jobs for the warm-up threads. The threads are daemons, so a
+# stopping worker exits without draining the queue; cache writes are atomic.
+_warm_queue: queue.Queue = queue.Queue()
+_warm_threads: list = []
+
+
+def walk_books(top, restat_files=True):
+    """Yield (path, mtime) for every supported book under top, in a single pass.
+
+    Directories whose mtime is unchanged since the last walk reuse their cached
+    listing instead of being re-read; each one still costs a single stat, since
+    adding a file only touches the mtime of its own directory. Overwriting a
+    book in place does not touch the directory either, so unless a watcher
+    reports those edits, the cached files are re-stat()ed with restat_files.
+    """
+    global _dir_cache, _stale_dirs
+    stale, _stale_dirs = _stale_dirs, set()
+    seen = {}
+    stack = [top]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            mtime_ns = os.stat(dirpath).st_mtime_ns
+        except OSError:
+            continue
+        cached = None if dirpath in stale else _dir_cache.get(dirpath)
+        if cached and cached[0] == mtime_ns:
+            files, subdirs = cached[1], cached[2]
+            if restat_files:
+                fresh = []
+                for path, _ in files:
+                    try:
+                        fresh.append((path, os.stat(path).st_mtime))
+                    except OSError:
+                        continue
+                files = fresh
+        else:
+            files, subdirs = [], []
+            try:
+                with os.scandir(dirpath) as it:
+                    for entry in it:
+                        # Skip hidden files and directories, as glob did
+                        if entry.name.startswith("."):
+                            continue
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append(entry.path)
+                            elif entry.is_file():
+                                ext = os.path.splitext(entry.name)[1].lower()
+                                if ext in MIME_TYPES:
+                                    files.append((entry.path, entry.stat().st_mtime))
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+        seen[dirpath] = (mtime_ns, files, subdirs)
+        yield from files
+        stack.extend(subdirs)
+    # Don't cache listings that may predate an event: ones invalidated during
+    # the walk, or in the swapped-out set by a handler that raced the swap
+    for dirpath in stale | _stale_dirs:
+        seen.pop(dirpath, None)
+    # Only directories that still exist are kept
+    _dir_cache = seen
+
+
+def make_book(path, mtime):
+    filename = os.path.basename(path)
+    title, ext = os.path.splitext(filename)
+    ext = ext.lower()
+    return {
+        "path": path,
+        "book_id": hashlib.blake2b(path.encode(), digest_size=16).hexdigest(),
+        "mtime": mtime,
+        "ext": ext,
+        "mime": MIME_TYPES.get(ext, "application/octet-stream"),
+        "rel": os.path.relpath(path, BOOKS_DIR),
+        "title": title,
+    }
+
+
+def set_scan_cache(books, updated, now):
+    global _scan_cache, _scan_time, _books_by_id, _scan_entries_xml, _scan_updated, _feed_cache
+    _books_by_id = {b["book_id"]: b for b in books}
+    # Entries before the feed cache, see get_feed()
+    _scan_updated = format_timestamp(updated)
+    _scan_entries_xml = "\n".join([book_to_entry(b) for b in books])
+    _feed_cache = {}
+    _scan_cache = books
+    _scan_time = now
+    warm_covers(books)
 
-def scan_books():
-    global _scan_cache, _scan_time, _book_paths
-    now = time.monotonic()
-    if now - _scan_time < SCAN_TTL and _scan_cache:
-        return _scan_cache
 
-    # Try filesystem cache before doing a full directory scan
+def load_scan_file():
+    """Return (books, updated) from scan.json if it is recent enough, or None."""
     try:
         with open(SCAN_CACHE_FILE) as f:
             data = json.load(f)
-        if time.time() - data["timestamp"] < SCAN_TTL:
-            books = [p for p in data["books"] if os.path.exists(p)]
-            _book_paths = {hashlib.md5(p.encode()).hexdigest(): p for p in books}
-            _scan_cache = books
-            _scan_time = now
-            return books
+        if data.get("version") == SCAN_CACHE_VERSION and time.time() - data["timestamp"] < SCAN_TTL:
+            return [b for b in data["books"] if os.path.exists(b["path"])], data["updated"]
     except Exception:
         pass
+    return None
+
+
+def scan_books():
+    global _scan_dirty
+    if WATCH_BOOKS:
+        start_watcher()
+    watching = _watcher is not None and _watcher.is_alive()
+    now = time.monotonic()
+    if _scan_cache:
+        if watching and not _scan_dirty:
+            return _scan_cache
+        if not watching and now - _scan_time < SCAN_TTL:
+            return _scan_cache
+    # Cleared before scanning so changes made during the scan trigger another one
+    _scan_dirty = False
+
+    # Try filesystem cache before doing a full directory scan. Not when watching:
+    # the file may predate changes this worker's watcher never saw, and nothing
+    # would trigger a rescan to correct it.
+    if not watching:
+        loaded = load_scan_file()
+        if loaded is not None:
+            books, updated = loaded
+            set_scan_cache(books, updated, now)
+            return books
 
     # Full scan
+    # The watcher already invalidates directories whose files were edited in place
+    found = list(walk_books(BOOKS_DIR, restat_files=not watching))
+    found.sort(key=lambda item: item[1], reverse=True)
+    # Reuse entries from the previous scan for unchanged files
+    known = {b["path"]: b for b in _scan_cache}
     books = []
-    for ext in MIME_TYPES:
-        pattern = os.path.join(BOOKS_DIR, f"**/*{ext}")
-        for path in glob.glob(pattern, recursive=True):
-            books.append(path)
-    books.sort(key=os.path.getmtime, reverse=True)
-    _book_paths = {hashlib.md5(p.encode()).hexdigest(): p for p in books}
-    _scan_cache = books
-    _scan_time = now
+    for path, mtime in found:
+        book = known.get(path)
+        if book is None or book["mtime"] != mtime:
+            book = make_book(path, mtime)
+        books.append(book)
+    dir_mtime = max((d[0] for d in _dir_cache.values()), default=0) / 1e9
+    updated = max(books[0]["mtime"] if books else 0, dir_mtime)
+    set_scan_cache(books, updated, now)
 
     try:
         with open(SCAN_CACHE_FILE, "w") as f:
-            json.dump({"timestamp": time.time(), "books": books}, f)
+            json.dump({"version": SCAN_CACHE_VERSION, "timestamp": time.time(), "updated": updated, "books": books}, f)
     except Exception:
         pass
 
     return books
 
 
+class BooksChangedHandler(FileSystemEventHandler):
+    def on_any_event(self, event):
+        global _scan_dirty
+        # Reads of a book (opened/closed events) do not change the catalog
+        if event.event_type not in ("created", "deleted", "modified", "moved"):
+            return
+        # In-place edits leave the directory mtime alone; force a re-read of it
+        _stale_dirs.add(os.path.dirname(event.src_path))
+        _scan_dirty = True
+
+
+def start_watcher():
+    """Watch BOOKS_DIR for changes, falling back to SCAN_TTL polling if that fails."""
+    global _watcher, _watcher_started
+    with _watcher_lock:
+        if _watcher_started:
+            return
+        _watcher_started = True
+        observer = Observer()
+        try:
+            observer.schedule(BooksChangedHandler(), BOOKS_DIR, recursive=True)
+            observer.start()
+        except Exception as e:
+            # e.g. inotify watch limit exhausted, or BOOKS_DIR missing
+            app.logger.warning("Not watching %s (%s); rescanning every %ss", BOOKS_DIR, e, SCAN_TTL)
+            return
+        _watcher = observer
+
+
+def parse_opf_cover(opf):
+    """Return the cover image href declared in raw OPF bytes, or None."""
+    cover_id = None
+    cover_image_href = None
+    hrefs = {}
+
+    def start_element(name, attrs):
+        nonlocal cover_id, cover_image_href
+        # Drop any namespace prefix, e.g. "opf:item"
+        tag = name.rpartition(":")[2]
+        if tag == "meta":
+            if cover_id is None and attrs.get("name") == "cover":
+                cover_id = attrs.get("content")
+        elif tag == "item" and attrs.get("href"):
+            href = attrs["href"]
+            if "id" in attrs:
+                hrefs.setdefault(attrs["id"], href)
+            if cover_image_href is None and "cover-image" in attrs.get("properties", "").split():
+                cover_image_href = href
+
+    parser = expat.ParserCreate()
+    # Skip undefined entities such as &nbsp; instead of failing on them
+    parser.UseForeignDTD(True)
+    parser.StartElementHandler = start_element
+    try:
+        parser.Parse(opf, True)
+        malformed = False
+    except expat.ExpatError:
+        malformed = True
+
+    # <meta name="cover"> takes precedence over properties="cover-image"
+    if cover_id and cover_id in hrefs:
+        return hrefs[cover_id]
+    if cover_image_href or not malformed:
+        return cover_image_href
+    # The manifest follows <metadata>, so a parse error there usually means no
+    # items were seen at all; scan the raw bytes instead
+    return regex_opf_cover(opf)
+
+
+def regex_opf_cover(opf):
+    """Return the cover image href found by pattern matching raw OPF bytes, or None."""
+    m = _RE_META_COVER_A.search(opf) or _RE_META_COVER_B.search(opf)
+    if m:
+        escaped_id = re.escape(m.group(1))
+        m = re.search(_ITEM_HREF_BY_ID_A % escaped_id, opf) or re.search(_ITEM_HREF_BY_ID_B % escaped_id, opf)
+    if not m:
+        m = _RE_COVER_IMAGE_PROP_A.search(opf) or _RE_COVER_IMAGE_PROP_B.search(opf)
+    if m:
+        return m.group(1).decode("utf-8", errors="ignore")
+    return None
+
+
+def read_member(z, fp, info):
+    """Read a zip member, slicing stored (uncompressed) ones straight out of fp."""
+    # Images are usually stored, so skip the decompressor and CRC pass for them
+    if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+        return z.read(info)
+    fp.seek(info.header_offset)
+    header = fp.read(30)
+    if len(header) != 30 or header[:4] != b"PK\x03\x04":
+        return z.read(info)
+    # The local header's name/extra lengths can differ from the central directory's
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    fp.seek(info.header_offset + 30 + name_len + extra_len)
+    data = fp.read(info.file_size)
+    if len(data) != info.file_size:
+        return z.read(info)
+    return data
+
+
 def extract_epub_cover(epub_path):
     """Return (image_bytes, mime_type) for the cover of an epub, or None."""
     try:
-        with zipfile.ZipFile(epub_path) as z:
-            names = z.namelist()
+        with open(epub_path, "rb") as fp, zipfile.ZipFile(fp) as z:
+            infos = z.infolist()
+            info_map = {info.filename: info for info in infos}
 
             # 1. Find OPF path via META-INF/container.xml
             opf_path = None
-            if "META-INF/container.xml" in names:
-                container = z.read("META-INF/container.xml").decode("utf-8", errors="ignore")
-                m = re.search(r'full-path="([^"]+\.opf)"', container)
+            if "META-INF/container.xml" in info_map:
+                container = z.read(info_map["META-INF/container.xml"])
+                m = _RE_OPF_PATH.search(container)
                 if m:
-                    opf_path = m.group(1)
-
-            if opf_path and opf_path in names:
-                opf = z.read(opf_path).decode("utf-8", errors="ignore")
-                opf_dir = os.path.dirname(opf_path)
-
-                # 2. Find cover item id from <meta name="cover" content="..."/>
-                cover_id = None
-                m = re.search(r'<meta\s+name=["\']cover["\']\s+content=["\']([^"\']+)["\']', opf)
-                if not m:
-                    m = re.search(r'<meta\s+content=["\']([^"\']+)["\']\s+name=["\']cover["\']', opf)
-                if m:
-                    cover_id = m.group(1)
-
-                # Also check for cover item with properties="cover-image"
-                if not cover_id:
-                    m = re.search(r'<item[^>]+properties=["\']cover-image["\'][^>]+href=["\']([^"\']+)["\']', opf)
-                    if not m:
-                        m = re.search(r'<item[^>]+href=["\']([^"\']+)["\'][^>]+properties=["\']cover-image["\']', opf)
-                    if m:
-                        cover_href = m.group(1)
-                        cover_full = os.path.join(opf_dir, cover_href).replace("\\", "/")
-                        if cover_full in names:
-                            data = z.read(cover_full)
-                            ext = os.path.splitext(cover_href)[1].lower()
-                            mime = "image/png" if ext == ".png" else "image/jpeg"
-                            return data, mime
-
-                if cover_id:
-                    # Find href for that item id
-                    m = re.search(
-                        rf'<item[^>]+id=["\'](?:{re.escape(cover_id)})["\'][^>]+href=["\']([^"\']+)["\']',
-                        opf,
-                    )
-                    if not m:
-                        m = re.search(
-                            rf'<item[^>]+href=["\']([^"\']+)["\'][^>]+id=["\'](?:{re.escape(cover_id)})["\']',
-                            opf,
-                        )
-                    if m:
-                        cover_href = m.group(1)
-                        cover_full = os.path.join(opf_dir, cover_href).replace("\\", "/")
-                        if cover_full in names:
-                            data = z.read(cover_full)
-                            ext = os.path.splitext(cover_href)[1].lower()
-                            mime = "image/png" if ext == ".png" else "image/jpeg"
-                            return data, mime
-
-            # 3. Fallback: look for any file named cover.*
-            for name in sorted(names):
-                basename = os.path.basename(name).lower()
-                if basename.startswith("cover") and basename.endswith((".jpg", ".jpeg", ".png")):
-                    data = z.read(name)
-                    mime = "image/png" if name.lower().endswith(".png") else "image/jpeg"
+                    opf_path = m.group(1).decode("utf-8", errors="ignore")
+
+            if opf_path in info_map:
+                # 2. Resolve the cover href declared in the OPF manifest
+                cover_href = parse_opf_cover(z.read(info_map[opf_path]))
+                if cover_href:
+                    cover_full = os.path.join(os.path.dirname(opf_path), cover_href).replace("\\", "/")
+                    if cover_full in info_map:
+                        data = read_member(z, fp, info_map[cover_full])
+                        ext = os.path.splitext(cover_href)[1].lower()
+                        mime = "image/png" if ext == ".png" else "image/jpeg"
+                        return data, mime
+
+            # 3. Fallback: first file in the archive named cover.*
+            for info in infos:
+                # Extension first: it rules out nearly every member of an epub
+                name = info.filename.lower()
+                if name.endswith((".jpg", ".jpeg", ".png")) and name.rpartition("/")[2].startswith("cover"):
+                    data = read_member(z, fp, info)
+                    mime = "image/png" if name.endswith(".png") else "image/jpeg"
                     return data, mime
 
     except Exception:
@@ -156,82 +406,279 @@ def extract_epub_cover(epub_path):
     return None
 
 
-def get_cover(book_id, path):
+def cover_cache_get(key):
+    with _cover_lock:
+        item = _cover_cache.get(key)
+        if item is None:
+            return _MISSING
+        expires, result = item
+        if time.monotonic() >= expires:
+            del _cover_cache[key]
+            return _MISSING
+        _cover_cache.move_to_end(key)
+        return result
+
+
+def cover_cache_put(key, result):
+    ttl = COVER_CACHE_TTL if result else COVER_NEGATIVE_TTL
+    with _cover_lock:
+        _cover_cache[key] = (time.monotonic() + ttl, result)
+        _cover_cache.move_to_end(key)
+        while len(_cover_cache) > COVER_CACHE_MAX:
+            _cover_cache.popitem(last=False)
+
+
+def warm_cover(book):
+    """Load (extracting if needed) a book's cover and make its thumbnail ahead of time."""
+    result = load_cover(book)
+    if result:
+        thumb_path = cover_cache_base(book) + ".thumb.jpg"
+        if not os.path.exists(thumb_path):
+            save_thumbnail(thumb_path, result[0])
+    return result
+
+
+def warm_worker():
+    while True:
+        book, future = _warm_queue.get()
+        # Skip jobs get_cover() cancelled to extract the cover itself
+        if not future.set_running_or_notify_cancel():
+            continue
+        try:
+            future.set_result(warm_cover(book))
+        except Exception as e:
+            future.set_exception(e)
+
+
+def warm_covers(books):
+    """Queue background cover extraction for the newest epubs not yet seen by this process."""
+    if COVER_WARM_WORKERS <= 0:
+        return
+    # Only as many as the in-memory cache holds; older results would just be evicted
+    epubs = [b for b in books if b["ext"] == ".epub"][:COVER_CACHE_MAX]
+    with _cover_lock:
+        # Started on first use rather than at import, so they run in each forked worker
+        while len(_warm_threads) < COVER_WARM_WORKERS:
+            thread = threading.Thread(target=warm_worker, name="cover-warm", daemon=True)
+            thread.start()
+            _warm_threads.append(thread)
+        pending = []
+        for book in epubs:
+            key = (book["book_id"], book["mtime"])
+            if key in _cover_warmed or key in _cover_cache:
+                continue
+            _cover_warmed.add(key)
+            future = Future()
+            _warm_queue.put((book, future))
+            pending.append((key, future))
+        # Books are newest first; insert them last so they are evicted last
+        expires = time.monotonic() + COVER_CACHE_TTL
+        for key, future in reversed(pending):
+            _cover_cache[key] = (expires, future)
+        while len(_cover_cache) > COVER_CACHE_MAX:
+            _cover_cache.popitem(last=False)
+
+
+def get_cover(book):
+    key = (book["book_id"], book["mtime"])
+    result = cover_cache_get(key)
+    if isinstance(result, Future):
+        if result.cancel():
+            # Still queued behind other books; extract it right away instead
+            result = _MISSING
+        else:
+            try:
+                result = result.result(timeout=COVER_WAIT_TIMEOUT)
+            except Exception:
+                result = _MISSING
+            else:
+                cover_cache_put(key, result)
+    if result is _MISSING:
+        result = load_cover(book)
+        cover_cache_put(key, result)
+    return result
+
+
+def write_cache_file(path, data):
+    """Atomically write data to path so concurrent workers never see a partial file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def cover_cache_base(book):
+    # Keyed on mtime so a replaced epub gets a fresh cover
+    return os.path.join(COVER_CACHE_DIR, f"{book['book_id']}-{int(book['mtime'])}")
+
+
+def remove_stale_covers(book):
+    """Delete cached cover files left behind by earlier versions of this book."""
+    current = os.path.basename(cover_cache_base(book)) + "."
+    for path in glob.glob(os.path.join(COVER_CACHE_DIR, f"{book['book_id']}-*")):
+        if not os.path.basename(path).startswith(current):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+def load_cover(book):
+    cache_base = cover_cache_base(book)
+
     # Check filesystem cache
     for cache_ext, mime in ((".jpg", "image/jpeg"), (".png", "image/png")):
-        cached = os.path.join(CACHE_DIR, book_id + cache_ext)
-        if os.path.exists(cached):
-            with open(cached, "rb") as f:
+        try:
+            with open(cache_base + cache_ext, "rb") as f:
                 return f.read(), mime
+        except OSError:
+            pass
 
     # Sentinel: cover was already looked up and not found
-    if os.path.exists(os.path.join(CACHE_DIR, book_id + ".none")):
+    if os.path.exists(cache_base + ".none"):
         return None
 
     # Extract cover
     result = None
-    if os.path.splitext(path)[1].lower() == ".epub":
-        result = extract_epub_cover(path)
+    if book["ext"] == ".epub":
+        result = extract_epub_cover(book["path"])
 
     if result:
         data, mime = result
         cache_ext = ".png" if mime == "image/png" else ".jpg"
         try:
-            with open(os.path.join(CACHE_DIR, book_id + cache_ext), "wb") as f:
-                f.write(data)
+            write_cache_file(cache_base + cache_ext, data)
         except Exception:
             pass
+        remove_stale_covers(book)
         return data, mime
 
     try:
-        open(os.path.join(CACHE_DIR, book_id + ".none"), "w").close()
+        write_cache_file(cache_base + ".none", b"")
     except Exception:
         pass
+    remove_stale_covers(book)
     return None
 
 
-def book_to_entry(path):
-    filename = os.path.basename(path)
-    title = os.path.splitext(filename)[0]
-    ext = os.path.splitext(filename)[1].lower()
-    mime = MIME_TYPES.get(ext, "application/octet-stream")
-    book_id = hashlib.md5(path.encode()).hexdigest()
-    rel = os.path.relpath(path, BOOKS_DIR)
-    mtime = datetime.fromtimestamp(os.path.getmtime(path), tz=timezone.utc)
-    download_url = f"{base_url()}/download/{quote(rel)}"
-    cover_url = f"{base_url()}/cover/{book_id}"
+def save_thumbnail(path, data):
+    """Write a JPEG thumbnail of the cover image data to path; return (bytes, mime) or None."""
+    try:
+        with Image.open(BytesIO(data)) as img:
+            # Lets the JPEG decoder scale down while decoding
+            img.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.Resampling.BILINEAR)
+            if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+                # JPEG has no alpha; flatten onto white rather than letting it go black
+                img = img.convert("RGBA")
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel("A"))
+                img = background
+            elif img.mode != "RGB":
+                img = img.convert("RGB")
+            out = BytesIO()
+            img.save(out, "JPEG", quality=85)
+    except Exception:
+        return None
+    thumb = out.getvalue()
+    try:
+        write_cache_file(path, thumb)
+    except Exception:
+        pass
+    return thumb, "image/jpeg"
+
+
+def load_thumbnail(book):
+    thumb_path = cover_cache_base(book) + ".thumb.jpg"
+    try:
+        with open(thumb_path, "rb") as f:
+            return f.read(), "image/jpeg"
+    except OSError:
+        pass
+
+    result = get_cover(book)
+    if not result:
+        return None
+    # Fall back to the full cover if it cannot be decoded
+    return save_thumbnail(thumb_path, result[0]) or result
+
+
+def get_thumbnail(book):
+    key = (book["book_id"], book["mtime"], "thumb")
+    result = cover_cache_get(key)
+    if result is _MISSING:
+        result = load_thumbnail(book)
+        cover_cache_put(key, result)
+    return result
+
+
+def format_timestamp(ts):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ts))
+
+
+def book_to_entry(book):
+    title = book["title"]
+    ext = book["ext"]
+    mime = book["mime"]
+    book_id = book["book_id"]
+    rel = book["rel"]
+    # URLs are escaped here; the base is substituted (pre-escaped) per request
+    download_url = f"{BASE_PLACEHOLDER}{escape(f'/download/{quote(rel)}')}"
+    cover_url = f"{BASE_PLACEHOLDER}/cover/{book_id}"
+    thumb_url = f"{BASE_PLACEHOLDER}/thumb/{book_id}"
 
     # Only include cover links for epub files; cover is fetched lazily on demand
     cover_links = ""
     if ext == ".epub":
         cover_links = f"""    <link rel="http://opds-spec.org/image"
-          href="{escape(cover_url)}"
+          href="{cover_url}"
           type="image/jpeg"/>
     <link rel="http://opds-spec.org/image/thumbnail"
-          href="{escape(cover_url)}"
+          href="{thumb_url}"
           type="image/jpeg"/>
 """
 
     return f"""  <entry>
     <title>{escape(title)}</title>
-    <id>urn:md5:{book_id}</id>
-    <updated>{mtime.strftime('%Y-%m-%dT%H:%M:%SZ')}</updated>
+    <id>urn:opds:book:{book_id}</id>
+    <updated>{format_timestamp(book["mtime"])}</updated>
 {cover_links}    <link rel="http://opds-spec.org/acquisition"
-          href="{escape(download_url)}"
+          href="{download_url}"
           type="{mime}"/>
   </entry>"""
 
 
-def make_feed(entries):
-    now = datetime.now(tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
-    opds_url = f"{base_url()}/opds"
-    entries_xml = "\n".join(entries)
+def get_feed(base):
+    """Return (xml_bytes, gzip_bytes, etag) of the catalog for base, rendering it once per scan."""
+    # Read the cache before the entries: a feed stored in a fresh cache was
+    # always rendered from the entries of the same scan
+    cache = _feed_cache
+    feed = cache.get(base)
+    if feed is None:
+        entries_xml = _scan_entries_xml.replace(BASE_PLACEHOLDER, escape(base))
+        xml = make_feed(entries_xml, base, _scan_updated).encode("utf-8")
+        feed = (xml, gzip.compress(xml), hashlib.blake2b(xml, digest_size=16).hexdigest())
+        if len(cache) >= FEED_CACHE_MAX:
+            cache.pop(next(iter(cache)), None)
+        cache[base] = feed
+    return feed
+
+
+def make_feed(entries_xml, base, updated):
+    opds_url = f"{base}/opds"
     return f"""<?xml version="1.0" encoding="UTF-8"?>
 <feed xmlns="http://www.w3.org/2005/Atom"
       xmlns:opds="http://opds-spec.org/2010/catalog">
   <id>urn:opds:library</id>
   <title>{escape(SERVER_TITLE)}</title>
-  <updated>{now}</updated>
+  <updated>{updated}</updated>
   <link rel="self"
         href="{escape(opds_url)}"
         type="application/atom+xml;profile=opds-catalog;kind=acquisition"/>
@@ -245,37 +692,92 @@ def make_feed(entries):
 @app.route("/opds")
 @app.route("/opds/")
 def catalog():
-    books = scan_books()
-    entries = [book_to_entry(p) for p in books]
-    xml = make_feed(entries)
-    return Response(
-        xml,
-        mimetype="application/atom+xml;profile=opds-catalog;kind=acquisition",
-    )
+    scan_books()
+    # Computed once per request; entries carry BASE_PLACEHOLDER instead
+    base = request.url_root.rstrip("/")
+    xml, xml_gzip, etag = get_feed(base)
+    if request.accept_encodings["gzip"] > 0:
+        response = Response(xml_gzip)
+        response.headers["Content-Encoding"] = "gzip"
+        # Each encoding is a distinct representation and needs its own validator
+        response.set_etag(etag + "-gzip")
+    else:
+        response = Response(xml)
+        response.set_etag(etag)
+    response.mimetype = "application/atom+xml;profile=opds-catalog;kind=acquisition"
+    response.vary.add("Accept-Encoding")
+    return response.make_conditional(request)
+
+
+def image_response(data, mime, etag):
+    response = Response(data, mimetype=mime)
+    # Cover bytes only change when the epub does, so the cache key is a strong validator
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 
 @app.route("/cover/<book_id>")
 def cover(book_id):
-    scan_books()  # ensure _book_paths is populated
-    path = _book_paths.get(book_id)
-    if not path:
+    scan_books()  # ensure _books_by_id is populated
+    book = _books_by_id.get(book_id)
+    if not book:
+        abort(404)
+    result = get_cover(book)
+    if result:
+        data, mime = result
+        return image_response(data, mime, f"{book_id}-{int(book['mtime'])}")
+    abort(404)
+
+
+@app.route("/thumb/<book_id>")
+def thumbnail(book_id):
+    scan_books()  # ensure _books_by_id is populated
+    book = _books_by_id.get(book_id)
+    if not book:
         abort(404)
-    result = get_cover(book_id, path)
+    result = get_thumbnail(book)
     if result:
         data, mime = result
-        return Response(data, mimetype=mime)
+        return image_response(data, mime, f"{book_id}-{int(book['mtime'])}-thumb")
     abort(404)
 
 
 @app.route("/download/<path:rel_path>")
 def download(rel_path):
-    safe_path = os.path.realpath(os.path.join(BOOKS_DIR, rel_path))
-    books_real = os.path.realpath(BOOKS_DIR)
-    if not safe_path.startswith(books_real + os.sep):
+    safe_path = os.path.realpath(os.path.join(BOOKS_REAL, rel_path))
+    if os.path.commonpath([safe_path, BOOKS_REAL]) != BOOKS_REAL:
         abort(403)
-    if not os.path.isfile(safe_path):
+    # Serve the file that was checked: O_NOFOLLOW refuses a symlink swapped in
+    # after realpath(), and everything below works on the open descriptor.
+    # O_NONBLOCK keeps a FIFO from hanging the open; it is a no-op for regular files.
+    try:
+        fd = os.open(safe_path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+    except OSError:
+        abort(404)
+    try:
+        st = os.fstat(fd)
+    except OSError:
+        os.close(fd)
+        abort(404)
+    if not stat.S_ISREG(st.st_mode):
+        os.close(fd)
         abort(404)
-    return send_file(safe_path, as_attachment=True)
+    f = os.fdopen(fd, "rb")
+    response = send_file(
+        f,
+        as_attachment=True,
+        download_name=os.path.basename(safe_path),
+        conditional=False,
+        etag=f"{st.st_mtime}-{st.st_size}-{st.st_ino}",
+        last_modified=st.st_mtime,
+    )
+    # send_file cannot size a file object, so handle Range/If-None-Match here
+    response.content_length = st.st_size
+    try:
+        return response.make_conditional(request, accept_ranges=True, complete_length=st.st_size)
+    except Exception:
+        response.close()
+        raise
 
 
 @app.route("/")